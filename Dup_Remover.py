@@ -54,7 +54,10 @@ __copyright__ = """Copyright (C) 2017 Devin Dinwiddie.
     
 import subprocess
 import logging
-import tempfile
+import re
+import itertools
+import collections
+import multiprocessing
 import sys
 import os
 
@@ -66,57 +69,66 @@ logging.basicConfig(filename='dup_remove.log', level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger=logging.getLogger(__name__)
 
+CIGAR_SOFT_RE=re.compile(rb"(?:\d+H)?(\d+)S") # leading soft clip of a cigar string, used with match()
+
 class sam_info(object):
     """ Filters a sam file line adjusts alignment start postion based on soft clipping amount, 
     converts quality into phred score, checks for strandeness and unique mapping, gets molecular ID from sam header
     
     Attributes:
-        line -- single line from a sam file (str)
+        line -- single line from a sam file (bytes)
         start_pos -- lines left most mapping postion soft clip adjusted (int)
-        qual_score --line mapq score (int)
+        qual_score --sum of the lines phred base qualities (int)
         strand -- lines strandeness (str)
-        BC -- unique index found in sam header (str)
+        BC -- unique index found in sam header (bytes)
         
     """
+    __slots__=('line','nr','bc_re','umis','fields','contig','start_pos','qual_score','strand','BC') # one object per read, no per instance __dict__
     
-    def __init__(self,line):
+    def __init__(self,line,nr,bc_re,umis=None,phred=True):
         """ init
         
         arguments
-        line-- a single line from a sorted sam file
+        line-- a single line from a sorted sam file, as bytes (sam files are ascii, no decoding needed)
+        nr-- record number of the line (for logging)
+        bc_re-- compiled bytes pattern matching the molecular tag at the end of the read name
+        umis-- set of known umis (bytes) to check the tag against, None to accept any tag (randomers)
+        phred-- compute qual_score, it is only compared when keeping the best duplicate (-q), 0 otherwise
         """
         self.line=line
-        self.contig=self.line.split('\t')[2]
-        self.start_pos=self.start_pos()
-        self.qual_score=self.line.split('\t')[4]
+        self.nr=nr
+        self.bc_re=bc_re
+        self.umis=umis
+        self.fields=line.split(b'\t',11) # split once, reused by the methods below. stops after QUAL, the optional tags are not needed
+        self.contig=self.fields[2]
         self.strand=self.bit_check()
+        if self.strand[1] is None: # read is dropped, skip the soft clip, phred and barcode work
+            self.start_pos=0
+            self.qual_score=0
+            self.BC=b""
+            return
+        self.start_pos=self.calc_start_pos()
+        self.qual_score=self.convert_phred() if phred else 0
         self.BC=self.barcode_get()
         
     def soft_check(self,align):
-        """ function to check for soft clipping *returns Soft clip amt"""
-        soft_amt=0
-        if align[1]=="S" :
-            soft_amt=align[0]
-        elif align[2]=="S" :
-            soft_amt=align[:2]
-    
-        return(int(soft_amt))
+        """ function to check for soft clipping at the start of the alignment (after any hard clipping) *returns Soft clip amt"""
+        soft=CIGAR_SOFT_RE.match(align)
+        if soft is None:
+            return 0
+        return int(soft.group(1))
 
-    #def convert_phred(self):
-        #"""Converts a quality score line into a phred score *returns the sum of individual character scores* 
-        #assumes phred score ASCII_BASE 33"""
-        #qual=(self.line.split("\t")[10])
-        #sum_qual=0
-        #for letter in qual:
-            #n = ord(letter) - 33
-            #sum_qual+=n
-            #return sum_qual
+    def convert_phred(self):
+        """Converts a quality score line into a phred score *returns the sum of individual character scores* 
+        assumes phred score ASCII_BASE 33"""
+        qual=self.fields[10].rstrip(b'\n') # QUAL is the last field when there are no tags
+        return sum(qual)-33*len(qual) # iterating bytes gives ints, summed in C with no per character ord()
         
-    def start_pos(self):
+    def calc_start_pos(self):
         """ returns the left most mapping postion of an alignment
         adjusted for soft clipping if soft clipping is found"""
-        start_pos=int(self.line.split("\t")[3])
-        align=self.line.split("\t")[5]
+        start_pos=int(self.fields[3])
+        align=self.fields[5]
         soft=self.soft_check(align)
         if soft  > 0:
             start_pos-=soft
@@ -127,25 +139,23 @@ class sam_info(object):
         ex: NS500451:204:HH7GHBGXY:1:11101:10281:1048:AACCCG -barcode length 6
         NS500451:204:HH7GHBGXY:1:11101:10281:1048-AACCCG^ACCGCN -barcode length 13 (include ^)
         returns the barcode. if no barcode found read will be logged in the log file"""
-        global NR
-        global umi_list
-        BC=self.line.split()[0].split(':')[-1]
-        #try:
-            #BC = subprocess.check_output("cat {sam} |cut -f 1 | grep -v '^@'|sed -n '{NR}'p |grep -o '{seq}'".format(sam=args.sam,NR=NR,seq=seq), shell=True,universal_newlines=True)
-            #BC=BC.strip()#get rid of newline char
-        #except:
-            #logger.error("Error@ line{co}: Could not find the indetifier in sam header,will not be included in output: {head}\n".format(co=NR,head=self.line.split("\t")[0]))
-            #pass
+        match=self.bc_re.search(self.fields[0])
+        if match is None:
+            if logger.isEnabledFor(logging.ERROR): # per read message, only built if it will be logged
+                logger.error("Error@ line%d: Could not find the indetifier in sam header,will not be included in output: %s\n",self.nr,self.fields[0].decode())
+            return b""
+        BC=match.group(0)
         
-        if args.umi:
-            if BC in umi_list:
+        if self.umis is not None:
+            if BC in self.umis:
                 
                 BC=BC
             
             else:
                 
-                BC=""
-                logger.error("Error@ line{co}: Not a valid umi,will not be included in output: {head}\n".format(co=NR,head=self.line.split("\t")[0]))
+                BC=b""
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.error("Error@ line%d: Not a valid umi,will not be included in output: %s\n",self.nr,self.fields[0].decode())
                 
         return BC
         
@@ -154,83 +164,140 @@ class sam_info(object):
         also gets the strandness (+ or -)
         *returns strandeness and empty string if uniq mapping
         *non uniq mapped will be returned but ignored for duplicates (ie not output)"""
-        flag=int(self.line.split("\t")[1])
+        flag=int(self.fields[1])
         strand="+"
         if ((flag & 4)!=4 and (flag & 256)!=256): #mapped and unique allignment
             umap= ""
         else:
             umap= None
-            logger.error("Error@ line{co}: Read is unmapped or non unique alligned, will not be included in output: {head}".format(co=COUNT,head=self.line.split("\t")[0]))
+            if logger.isEnabledFor(logging.ERROR):
+                logger.error("Error@ line%d: Read is unmapped or non unique alligned, will not be included in output: %s",self.nr,self.fields[0].decode())
         if ((flag & 16))==16: #strand is -
             strand="-"
         return (strand,umap)
     
-#class rmdup(object):
-    #""" interates a sam file collects Unique non pcr duplicate reads with best quality"""
-    #def __init__(self):
-        #self.self=self
-        #""" init
-        
-        
-        #"""
-        
-    
-def inter_sam(sorted_sam):
+def parse_reads(lines,nr,bc_re,umis=None,phred=True):
+    """ filters and parses sam alignment lines *yields (key,qual score,line) for each line
+    key is (barcode,start_pos and strand packed in one int (low bit set for -),contig), None for unmapped or secondary allignments and "" for no barcode or unknown umi
+    arguments
+    lines-- sam alignment lines (no @ header lines)
+    nr-- record number of the first line (for logging)
+    bc_re, umis, phred-- see sam_info
+    """
+    for nr,line in enumerate(lines,nr):
+        read=sam_info(line,nr,bc_re,umis,phred)
+        if read.strand[1] is None: # not mapped or secondary allignment
+            yield None,0,None
+        elif not read.BC: # if no barcode or unknown umi
+            yield "",0,None
+        else:
+            yield (read.BC,(read.start_pos<<1)|(read.strand[0]=="-"),read.contig),read.qual_score,line
+
+def parse_batch(batch,nr,bc_re,umis,phred):
+    """ parse_reads for one batch of lines in a worker process *returns a list of (key,qual score,line)"""
+    return list(parse_reads(batch,nr,bc_re,umis,phred))
+
+def parse_parallel(lines,threads,bc_re,umis=None,phred=True,batch_size=20000):
+    """ parse_reads spread over threads worker processes *yields the same records in the same order
+    lines are sent to the workers in batches, at most 2 batches per worker are in flight so memory stays bounded"""
+    pending=collections.deque()
+    nr=1
+    with multiprocessing.Pool(threads) as pool:
+        for batch in iter(lambda: list(itertools.islice(lines,batch_size)),[]):
+            pending.append(pool.apply_async(parse_batch,(batch,nr,bc_re,umis,phred)))
+            nr+=len(batch)
+            if len(pending)>=2*threads:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+def inter_sam(sorted_sam,dedup,bc_re,umis=None,pe=False,keep_best=False,threads=1):
     
     """ interates a sam file and removes pcr duplicates if removal conditions are met. assumes sorted sam file
+    *returns the place dict of kept paired end reads (empty for single end) and the counts (reads processed, unmapped or secondary, unidentified barcodes, single end reads written)
     arguments
     sorted sam-- a sam file that has been sorted by alignment postion (ie *samtools sort, -s flag)
+    dedup-- open output handle, the header (and single end reads) are written to it (see open_output)
+    bc_re, umis-- see sam_info
+    pe-- paired end data, kept reads are returned for pair_write instead of written
+    keep_best-- keep the duplicate with the highest quality score instead of the 1st one (-q)
+    threads-- number of worker processes used to parse the reads
     """
         
-    global NR
-    global UnMap
-    global place
-    global tot
-    global badBc
+    NR=0 # record counter
+    UnMap=0 #unmapped counter
+    badBc=0 # unidentified barcode
+    tot=0 # single end reads written
+    place={}
     logger.info("Checking sorted sam file {sam} for pcr duplicates\n".format(sam=sorted_sam))
-    with open(sorted_sam)as sam:
+    if not pe:
+        logger.info("writing sam formatted file with PCR duplicates removed\n")
+    with open(sorted_sam,'rb',buffering=16<<20)as sam: # bytes, large reads, close to the disk bandwidth
+
+        line=sam.readline()
+        while line.startswith(b'@'): #write @ line info to output file, header lines are only at the top
+            dedup.write(line)
+            line=sam.readline()
 
+        lines=itertools.chain([line] if line else [],sam) # alignment records only from here on
+        if threads>1: # parse in worker processes, dedup the parsed reads here in order
+            reads=parse_parallel(lines,threads,bc_re,umis,phred=keep_best)
+        else:
+            reads=parse_reads(lines,1,bc_re,umis,phred=keep_best) # quality scores are only compared with -q
 
-        for line in sam:
+        contig=None # contig currently held in place (single end only)
+        done=set() # contigs already written out
+        seen=set() # keys already written on the current contig (single end without -q)
+        place_get=place.get # bound once, place and seen are cleared, never replaced
+        seen_add=seen.add
+        write=dedup.write
+        for key,qual,line in reads:
 
-            if line.startswith('@'): #write @ line info to output file
-                with open(args.sam+"_deduped",'a') as dedup:
-                    dedup.write(line)
-            else:
-                
-                NR+=1
-                #if NR%10==0: #test to make sure its running
-                    #print(NR)
-                line=sam_info(line)
-                key=line.BC,line.start_pos,line.strand[0],line.contig #(barcode,start_pos, +or-,contig)
+            NR+=1
+            if key is None  : # not mapped or secondary allignment or no index in header *ignore
+                UnMap +=1
+                continue
+            
+            elif not key: # if no barcode or unknown umi
+                badBc+=1
+                continue
+
+            if not pe and key[2] != contig: # sorted input: no later read can be a duplicate of a read on a finished contig, write them out now
+                if key[2] in done:
+                    logger.error("Error: contig {contig} seen again at read {head}, the sam file is not sorted (use --sort)\n".format(contig=key[2].decode(),head=line.split(b"\t",1)[0].decode()))
+                    sys.exit(1)
+                dedup_writer.single_write(place,dedup)
+                tot+=len(place)
+                place.clear()
+                seen.clear()
+                done.add(contig)
+                contig=key[2]
 
-                if line.strand[1] is None  : # not mapped or secondary allignment or no index in header *ignore
-                    UnMap +=1
-                    continue
+            if not pe and not keep_best: # 1st read of duplicates is retained, write it now and only keep its key
+                if key not in seen:
+                    seen_add(key)
+                    write(line)
+                    tot+=1
+                continue
+            
+            best=place_get(key) #look in dictionary, one hashed lookup per read (value is qual score,line)
+            
+            if best is None:  #if values is not in dict put it in with qual score, line as value 
                 
-                elif line.BC is "": # if no barcode or unknown umi
-                    badBc+=1
-                    continue
+                place[key]=(qual,line)
+            
+            elif keep_best and best[0] < qual : # if keeping highest quality score and current line is highest replace with qual score, current line
                 
-                elif key in place: #look in dictionary 
-                    
-                    if args.qual: #if keeping highest mapq score
-                    
-                        if place[key][1] < line.qual_score : # if val is in dict but current line quality score is highest replace with current line, qual score
-                            
-                            place[key] = (line.line,line.qual_score)
-                        
-                        else:#for cases where duplicates with same quality score 1st read will be retained 
-                            
-                            continue
-                    else: # if args.qual not set 1st read of duplicates encountered will be retained
-                        continue
-    
-                else:  #if values is not in dict put it in with line, qual score as value 
-                    
-                    place[key]=(line.line,line.qual_score)
-                    
-        return 
+                place[key]=(qual,line)
+            
+            # otherwise the 1st read of duplicates encountered (or of duplicates with the same quality score) is retained
+
+        if not pe: # last contig
+            dedup_writer.single_write(place,dedup)
+            tot+=len(place)
+            place.clear()
+                
+        return place,(NR,UnMap,badBc,tot)
 
 class dedup_writer(object):
     """object for writing output duplicates removed sam file"""
@@ -238,53 +305,70 @@ class dedup_writer(object):
         self.self=self
         """__init__"""
         
-    def single_write(place):
+    def single_write(place,dedup):
         
-        """ writer for single end data. outputs contents of place dict to "inputsam"_deduped.sam in directory where script is run"""
-        logger.info("writing sam formatted file with PCR duplicates removed\n")
-        #with open(args.sam.split(".")[0]+"_deduped.sam",'w') as dedup:
-        with open(args.sam+"_deduped",'a') as dedup:
-            for value in place.values():
-                dedup.write('{}'.format(value[0]))
+        """ writer for single end data. outputs contents of place dict to the open "inputsam"_deduped.sam file handle dedup, called once per contig while the sam is read"""
+        dedup.writelines(line for qual,line in place.values())
             
-    def pair_write(place):
-        """ writer for paired end data. outputs contents of place dict to "inputsam"_PE_deduped.sam in directory where script was run. assumes ordered dict, reades with no matching pair will be ignored.
-        checks qname of 1st entry matches rname of 2nd entry""" 
+    def pair_write(place,dedup):
+        """ writer for paired end data. outputs contents of place dict to the open "inputsam"_deduped file handle dedup. assumes ordered dict, reades with no matching pair will be ignored.
+        checks qname of 1st entry matches rname of 2nd entry *returns the number of paired reads written""" 
         logger.info("writing Paired End sam formatted file with PCR duplicates removed\n")
         pecount=0
-        global peRemo
-        #with open(args.sam.split(".")[0]+"_PE_deduped.sam",'w') as dedup:
-        with open(args.sam+"_deduped",'a') as dedup:
-            firstvals = [v for v in sorted(list(place.values()))] # sort the dict values by header name (paired end will be inline with each other)
-            while pecount < len(place)-1:
-            
-                 
-                first2vals=firstvals[pecount:pecount+2] #grab the values from the sorted dict 2 at a time
-            
-                if first2vals[0][0].split("\t")[3] == first2vals[1][0].split("\t")[7]: #pos == pnext
-                    dedup.write(first2vals[0][0]+first2vals[1][0]) #write the lines (dict value is line,qual score)
-                    pecount+=2
-                    peRemo+=2
-                    continue
-                else:
-                    pecount+=1
-                    logger.info("non Paired end@ line{co}: Could not find the matching pair ,will not be included in output: {head}\n".format(co=(pecount),head=first2vals[0]))
-                    continue
-        
-        
+        peRemo=0 # paired reads written
+        firstvals = sorted(line for qual,line in place.values()) # sort the dict lines by header name (paired end will be inline with each other)
+        while pecount < len(place)-1:
         
+             
+            first2vals=firstvals[pecount:pecount+2] #grab the lines from the sorted dict 2 at a time
         
+            if first2vals[0].split(b"\t",4)[3] == first2vals[1].split(b"\t",8)[7]: #pos == pnext
+                dedup.write(first2vals[0]+first2vals[1]) #write the lines
+                pecount+=2
+                peRemo+=2
+                continue
+            else:
+                pecount+=1
+                logger.info("non Paired end@ line{co}: Could not find the matching pair ,will not be included in output: {head}\n".format(co=(pecount),head=first2vals[0].decode()))
+                continue
+        return peRemo
+    
+    
+    
+    
 def sort_sam(sam,out):
     """ sorts a sam file by left most mapping postion * defaults to 3M temp memory storage and 28 nodes (see samtools manual -m,-@) may need adjustments based on user system"""
-    with tempfile.TemporaryFile() as f: #uses a temp file
-        try:
-            logger.info("sorting input sam file {sam}\n".format(sam=sam))
-            output=subprocess.check_output("samtools view -bS {sam} |samtools sort -m 3M -@ 28 -o {out}.sam ".format(sam=sam,out=out),shell=True,stderr=subprocess.STDOUT) #runs samtools
-            logger.info("sorted input sam file {sam} and output to {out}.sam\n".format(sam=sam,out=out))
-        except subprocess.CalledProcessError as er :
-            logger.error("error sorting sam file:\n{error}\n".format(error=er.output)) #logs any errors
-            exit(1)
+    try:
+        logger.info("sorting input sam file {sam}\n".format(sam=sam))
+        # samtools sort reads the sam directly, no shell and no intermediate sam->bam conversion
+        output=subprocess.check_output(["samtools","sort","-m","3M","-@","28","-O","sam","-o",out+".sam",sam],stderr=subprocess.STDOUT) #runs samtools
+        logger.info("sorted input sam file {sam} and output to {out}.sam\n".format(sam=sam,out=out))
+    except subprocess.CalledProcessError as er :
+        logger.error("error sorting sam file:\n{error}\n".format(error=er.output)) #logs any errors
+        sys.exit(1)
+    except OSError as er : # samtools not installed or not on the PATH
+        logger.error("error running samtools:\n{error}\n".format(error=er))
+        sys.exit(1)
                 
+def open_output(out_name,bam,threads):
+    """ opens the output file for writing bytes *returns the file handle and the samtools process (None for sam output)
+    bam output is sam text piped into samtools view, which compresses with threads bgzf threads in total"""
+    if not bam:
+        return open(out_name,'wb',buffering=1<<20),None
+    try:
+        proc=subprocess.Popen(["samtools","view","-b","-@",str(max(threads-1,0)),"-o",out_name,"-"],stdin=subprocess.PIPE,bufsize=1<<20)
+    except OSError as er : # samtools not installed or not on the PATH
+        logger.error("error running samtools:\n{error}\n".format(error=er))
+        sys.exit(1)
+    return proc.stdin,proc
+
+def close_output(dedup,proc):
+    """ closes the output file and waits for samtools to finish writing bam output"""
+    dedup.close()
+    if proc is not None and proc.wait()!=0:
+        logger.error("error writing bam file: samtools exited with status {code}\n".format(code=proc.returncode))
+        sys.exit(1)
+
 def file_check(parser, arg):
     """ checks if input files exist"""
     if not os.path.exists(arg):
@@ -306,43 +390,38 @@ if __name__ == '__main__':
     ogroup.add_argument('-o','--out', dest='out_prefix', help='prefix of output file for sorted sam (optional if input is already sorted)',type=str)
     ogroup.add_argument('-s','--sort', dest='sort',action='store_true', default=False, help="input sam file needs to be sorted")
     ogroup.add_argument('-u','--umi', dest='umi',action='store_true', default=False, help="check index against 96 know umi's")
-    ogroup.add_argument('-q','--qual', dest='qual',action='store_true', default=False, help="keep the read with the highest mapq score when duplicates found")
-    #ogroup.add_argument('-l','--length', dest='length', type=int, help="length of molecular tag sequence",required=True)
+    ogroup.add_argument('-q','--qual', dest='qual',action='store_true', default=False, help="keep the read with the highest summed phred quality score when duplicates found")
+    ogroup.add_argument('-b','--bam', dest='bam',action='store_true', default=False, help="write the output as bam (\"inputsam\"_deduped.bam) * assumes samtools is installed")
+    ogroup.add_argument('-t','--threads', dest='threads', type=int, default=1, help="number of processes used to parse the sam and threads for bam compression (default 1)")
+    ogroup.add_argument('-l','--length', dest='length', type=int, help="length of molecular tag sequence",required=True)
     ogroup.add_argument('-v','--version', action='version', version='%(prog)s '+ __version__)
     ogroup.add_argument('-h','--help',action='help', help='show this help message and exit')
 
     args = parser.parse_args()
-    #sam=args.sam #name of sam file
-    #ID=args.length #length of index
-    NR=0 # record counter
-    UnMap=0 #unmapped counter
-    peRemo=0 # non paired end counter
-    tot=0 # total reads in dict
-    badBc=0 # unidentified barcode
-    #seq="[ACGTN^-]\{%d,\}" %ID #target index
-    place={}
-    umi_list=[]
+    ID=args.length #length of index
+    bc_re=re.compile(rb"[ACGTN^-]{%d,}$" %ID) #target index, at the end of the read name
+    umis=None
     
-    if args.umi:  # make a list of known umis
+    if args.umi:  # make a set of known umis
         
-        with open("STL96.txt") as u:
+        umis=set()
+        with open("STL96.txt",'rb') as u:
             for line in u:
                 line=line.strip()
-                umi_list.append(line)
+                umis.add(line)
                 
     if args.sort: #  sorting a sam file
         sort_sam(args.sam,args.out_prefix)
         args.sam=str(args.out_prefix +'.sam')
-        inter_sam(str(args.sam))
-    else:
-        inter_sam(str(args.sam))
+    out_name=os.path.splitext(args.sam)[0]+("_deduped.bam" if args.bam else "_deduped.sam") # "inputsam"_deduped.sam/bam, next to the input sam
+    dedup,writer=open_output(out_name,args.bam,args.threads)
+    place,(NR,UnMap,badBc,tot)=inter_sam(str(args.sam),dedup,bc_re,umis,pe=args.pe,keep_best=args.qual,threads=args.threads)
       
-    if not args.pe: #writing output (dups removed)
-        dedup_writer.single_write(place)
-        tot+=len(place)
+    if not args.pe: #output (dups removed) was written while reading the sam
         logger.info("Dup Remover Summary Statistics\nTotal reads processed: {NR}\nTotal unmapped or secondary allignments: {unmap}\nTotal unidentified barcodes: {badbc}\nTotal duplicates removed: {DR}\nTotal reads retained: {D}\n".format(NR=NR,D=tot,unmap=UnMap,DR=NR-UnMap-tot,badbc=badBc))
     else:
-        dedup_writer.pair_write(place)
-        tot+=len(place)
+        peRemo=dedup_writer.pair_write(place,dedup)
+        tot=len(place)
         logger.info("Dup Remover Summary Statistics(Paired End)\nTotal reads processed: {NR}\nTotal unmapped or secondary allignments: {unmap}\nTotal unidentified barcodes: {badbc}\nTotal duplicates removed: {DR}\nTotal non paired reads: {rm}\nTotal P.E reads retained: {D}\n".format(NR=NR,D=peRemo,unmap=UnMap,DR=NR-UnMap-tot,rm=tot-peRemo,badbc=badBc))
         
+    close_output(dedup,writer)